@@ -202,17 +202,20 @@ class BirstClient(object):
             self.logger.debug("Query:\n{querystring}".format(querystring=query))
             self.logger.debug("Space: {spaceid}".format(spaceid=space))
             self.logger.debug("Handled by {handler_class}."
-                              .format(handler_class=handler.__name__ if handler else "raw output"))
+                              .format(handler_class=getattr(handler, "__name__", handler.__class__.__name__)
+                                      if handler else "raw output"))
 
             result = self.connector.service.executeQueryInSpace(self.token,
                                                                 query,
                                                                 space)
 
         if handler:
-            self.logger.debug("Submitting rows to handler {handler_class_name}."
-                              .format(handler.__class__.__name__))
-            _handler = handler()
-            return _handler.process(result)
+            self.logger.debug("Submitting rows to handler {handlerclass}.".format(handlerclass=handler))
+            if isinstance(handler, types.TypeType):
+                _handler = handler()
+                return _handler.process(result)
+            else:
+                return handler.process(result)
         else:
             return result
 
@@ -244,7 +247,8 @@ class BirstClient(object):
             self.logger.debug("Query:\n{querystring}".format(querystring=query))
             self.logger.debug("Space: {spaceid}".format(spaceid=space))
             self.logger.debug("Handled by {handler_class}."
-                              .format(handler_class=handler.__name__ if handler else "raw output"))
+                              .format(handler_class=getattr(handler, "__name__", handler.__class__.__name__)
+                                      if handler else "raw output"))
 
             result = self.connector.service.executeQueryInSpace(self.token,
                                                                 query,
@@ -1,7 +1,10 @@
 # coding=utf-8
 
 import pandas as pd
+import numpy as np
+import multiprocessing
 import logging
+import os
 import json
 
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
@@ -9,6 +12,43 @@ pd.set_option('display.float_format', lambda x: '%.3f' % x)
 module_logger = logging.getLogger("pyrst.client")
 module_logger.setLevel(logging.DEBUG)
 
+# Query output and handler of the sharded conversion that a worker process
+# is part of. This is only ever set in the worker processes, by the pool
+# initializer. The workers are forked, so the query output is inherited from
+# the memory of the parent instead of being pickled over to them, and only the
+# shard bounds travel to the workers. This is not free: reading a row updates
+# its reference counts, so each worker ends up with its own copy of the memory
+# pages holding its shard. The converted shards are pickled whole on their way
+# back to the parent, including every string in their `object` columns.
+_worker_state = None
+
+
+def _init_shard_worker(query_output,
+                       handler):
+    """
+    Worker initializer for sharded conversion. Stores the query output and
+    the handler the worker converts the rows with.
+
+    :param query_output: raw query output
+    :param handler: handler converting the rows
+    :type handler: Handler
+    """
+    global _worker_state
+    _worker_state = (query_output, handler)
+
+
+def _process_shard(bounds):
+    """
+    Worker entry point for sharded conversion. Converts the rows between the
+    bounds of the query output inherited from the parent process.
+
+    :param bounds: start and stop row index of the shard
+    :type bounds: tuple
+    :return: converted shard
+    """
+    query_output, handler = _worker_state
+    return handler._process_shard(query_output, *bounds)
+
 
 class Handler(object):
     """
@@ -36,11 +76,152 @@ class Handler(object):
         return query_output
 
 
-class DfHandler(Handler):
+class _ShardedHandler(Handler):
+    """
+    Handler that can convert the rows in parallel, split into shards, using a
+    pool of worker processes.
+
+    Sharded handlers implement _process_shard(), converting a range of rows,
+    and _combine(), combining the converted shards in row order.
+    """
+
+    def __init__(self,
+                 processes=None,
+                 shard_size=100000):
+        """
+        Sets the execution options of the handler.
+
+        :param processes: number of worker processes to convert the rows with
+        (default: None, converting the rows in the calling process)
+        :type processes: int
+        :param shard_size: number of rows converted by a worker at a time
+        :type shard_size: int
+        :raise: ValueError if `processes` or `shard_size` is less than 1.
+        """
+        if processes is not None and processes < 1:
+            raise ValueError("The number of processes must be at least 1, not {processes}."
+                             .format(processes=processes))
+        if shard_size < 1:
+            raise ValueError("The shard size must be at least 1, not {shard_size}."
+                             .format(shard_size=shard_size))
+
+        self.processes = processes
+        self.shard_size = shard_size
+
+    def _map_shards(self,
+                    query_output):
+        """
+        Converts the rows of the query output shard by shard, using a pool of
+        worker processes if the handler was set up with more than one process
+        and there is more than one shard's worth of rows. Otherwise, all rows
+        are converted as a single shard in the calling process.
+
+        Worker processes are forked, and inherit the rows from the parent
+        process. On platforms that cannot fork, the rows are converted in
+        the calling process.
+
+        :param query_output: raw query output
+        :return: list of converted shards, in row order
+        :rtype: list
+        """
+        _row_count = len(query_output["rows"])
+
+        if not self.processes or self.processes < 2 or _row_count <= self.shard_size:
+            return [self._process_shard(query_output, 0, _row_count)]
+
+        if not hasattr(os, "fork"):
+            self.logger.warning("Cannot fork worker processes, converting rows in a single process.")
+            return [self._process_shard(query_output, 0, _row_count)]
+
+        _bounds = [(start, min(start + self.shard_size, _row_count))
+                   for start in range(0, _row_count, self.shard_size)]
+
+        self.logger.debug("Converting {rows} rows in {shards} shards using {processes} processes."
+                          .format(rows=_row_count,
+                                  shards=len(_bounds),
+                                  processes=self.processes))
+
+        if hasattr(multiprocessing, "get_context"):
+            _context = multiprocessing.get_context("fork")
+        else:
+            _context = multiprocessing
+
+        _pool = _context.Pool(self.processes,
+                              initializer=_init_shard_worker,
+                              initargs=(query_output, self))
+        try:
+            _shards = _pool.map(_process_shard, _bounds)
+        except BaseException:
+            _pool.terminate()
+            raise
+        _pool.close()
+        _pool.join()
+        return _shards
+
+    def _process_shard(self,
+                       query_output,
+                       start,
+                       stop):
+        """
+        Converts the rows of the query output between `start` and `stop`.
+
+        :param query_output: raw query output
+        :param start: index of the first row of the shard
+        :type start: int
+        :param stop: index after the last row of the shard
+        :type stop: int
+        :return: converted shard
+        """
+        raise NotImplementedError
+
+    def _combine(self,
+                 shards):
+        """
+        Combines the converted shards into the output of the handler.
+
+        :param shards: list of converted shards, in row order
+        :type shards: list
+        :return: output of the handler
+        """
+        raise NotImplementedError
+
+
+class DfHandler(_ShardedHandler):
     """
     Handler that returns a `pandas` `DataFrame`.
+
+    Dimension columns can be dictionary encoded while the rows are decoded,
+    and returned as `pandas` `Categorical` columns, so that each distinct
+    value is only stored once.
     """
-    def __init__(self):
+    def __init__(self,
+                 categorical=False,
+                 max_categories=1000,
+                 processes=None,
+                 shard_size=100000):
+        """
+        Creates a DataFrame handler.
+
+        Possible dictionary encoding settings are:
+        - False (default): dimension columns are returned as `object` columns
+        - auto: dimension columns with at most `max_categories` distinct
+        values are returned as `Categorical` columns
+        - True: all dimension columns are returned as `Categorical` columns
+
+        :param categorical: dictionary encoding setting for dimension columns
+        :param max_categories: highest number of distinct values of a
+        dimension column that is dictionary encoded in `auto` mode
+        :type max_categories: int
+        :param processes: number of worker processes to convert the rows with
+        (default: None, converting the rows in the calling process)
+        :type processes: int
+        :param shard_size: number of rows converted by a worker at a time
+        :type shard_size: int
+        """
+        super(DfHandler, self).__init__(processes=processes,
+                                        shard_size=shard_size)
+        self.categorical = categorical
+        self.max_categories = max_categories
         self.logger = logging.getLogger("pyrst.client")
         self.logger.info("Setting up handler...")
 
@@ -55,7 +236,33 @@ class DfHandler(Handler):
         """
         self.logger.debug("Processing query output...")
 
-        _series = [each[0] for each in query_output["rows"]]
+        _df = self._combine(self._map_shards(query_output))
+
+        self.logger.debug("Processing columns {columnlist}.".format(columnlist=', '.join(list(_df.columns))))
+        return _df
+
+    def _process_shard(self,
+                       query_output,
+                       start,
+                       stop):
+        """
+        Converts the rows of the query output between `start` and `stop` into
+        a `pandas` `DataFrame`, indexed by the position of the rows in the
+        query output.
+
+        When dimension columns are dictionary encoded, the DataFrame is built
+        one column at a time, and dimension columns are factorized straight
+        from the rows, without building an `object` column first.
+
+        :param query_output: raw query output
+        :param start: index of the first row of the shard
+        :type start: int
+        :param stop: index after the last row of the shard
+        :type stop: int
+        :return: `pandas` `DataFrame` object representing the shard
+        :rtype: DataFrame
+        """
+        _series = [each[0] for each in query_output["rows"][start:stop]]
 
         _typemap = {12: "object", 8: "float"}
 
@@ -63,18 +270,77 @@ class DfHandler(Handler):
         for k, v in enumerate(query_output["dataTypes"]):
             _types[k] = _typemap[v]
 
-        _df = pd.DataFrame(_series)
+        _index = range(start, stop)
 
-        _df.columns = query_output["columnNames"]
+        if not self.categorical:
+            _df = pd.DataFrame(_series, index=_index)
 
-        for k, v in enumerate(_df.columns):
-            _df[v] = _df[v].astype(_types[k])
+            _df.columns = query_output["columnNames"]
+
+            for k, v in enumerate(_df.columns):
+                _df[v] = _df[v].astype(_types[k])
+
+            return _df
+
+        _df = pd.DataFrame(index=_index)
+
+        for k, v in enumerate(query_output["columnNames"]):
+            _values = [each[k] for each in _series]
+            if query_output["dataTypes"][k] == 12:
+                _codes, _categories = pd.factorize(np.array(_values, dtype=object))
+                _df[v] = pd.Categorical.from_codes(_codes, _categories)
+            else:
+                _df[v] = pd.Series(_values, index=_index).astype(_types[k])
 
-        self.logger.debug("Processing columns {columnlist}.".format(columnlist=', '.join(list(_df.columns))))
         return _df
 
+    def _combine(self,
+                 shards):
+        """
+        Concatenates the `DataFrame` shards in row order.
+
+        The dictionaries of the `Categorical` columns of the shards are merged,
+        and their codes are remapped onto the merged dictionary. In `auto`
+        mode, columns whose merged dictionary has more than `max_categories`
+        values are decoded into `object` columns.
+
+        :param shards: list of `DataFrame` shards
+        :type shards: list
+        :return: `pandas` `DataFrame` object representing the result
+        :rtype: DataFrame
+        """
+        _df = shards[0] if len(shards) == 1 else pd.concat(shards)
+
+        for v in _df.columns:
+            _columns = [shard[v] for shard in shards]
+
+            if str(_columns[0].dtype) != "category":
+                continue
+
+            if len(_columns) == 1:
+                _categories = _columns[0].cat.categories
+                _codes = np.asarray(_columns[0].cat.codes)
+            else:
+                _categories = pd.Index(pd.unique(np.concatenate([column.cat.categories.values
+                                                                 for column in _columns])))
+                # Missing values have the code -1, which picks the -1 appended
+                # to the end of each mapping, even if a shard has no values.
+                _codes = np.concatenate([np.append(_categories.get_indexer(column.cat.categories), -1)
+                                         [np.asarray(column.cat.codes)]
+                                         for column in _columns])
+
+            if self.categorical == "auto" and len(_categories) > self.max_categories:
+                # Likewise, the None appended to the dictionary decodes missing values.
+                _df[v] = pd.Series(np.append(np.asarray(_categories, dtype=object), [None])[_codes],
+                                   index=_df.index,
+                                   dtype="object")
+            else:
+                _df[v] = pd.Categorical.from_codes(_codes, _categories)
+
+        return _df
 
-class JsonHandler(Handler):
+
+class JsonHandler(_ShardedHandler):
     """
     Handler that returns a JSON file, ready to be ingested by D3.
 
@@ -86,10 +352,13 @@ class JsonHandler(Handler):
 
     def __init__(self,
                  orient="records",
-                 date_format="iso"):
+                 date_format="iso",
+                 processes=None,
+                 shard_size=100000):
         """
         Creates a JSON handler. Accepts an encoding orientation and a datetime
-        format setting.
+        format setting, as well as the number of worker processes and the
+        shard size to convert the rows with.
 
         Possible encoding formats are the same as for the `pandas` `DataFrame`
         `to_csv` method:
@@ -101,6 +370,7 @@ class JsonHandler(Handler):
         - columns: one dict per column, assigning a dict of index-value pairs
         to the column name
         - values: just the values array
+        - table: one dict with the table schema and the records as data
 
         Possible datetime formats are:
         - iso (default): ISO8601 date format
@@ -108,9 +378,17 @@ class JsonHandler(Handler):
 
         :param orient: encoding orientation
         :param date_format: datetime format
+        :param processes: number of worker processes to convert the rows with
+        (default: None, converting the rows in the calling process)
+        :type processes: int
+        :param shard_size: number of rows converted by a worker at a time
+        :type shard_size: int
         """
+        super(JsonHandler, self).__init__(processes=processes,
+                                          shard_size=shard_size)
         self.orient = orient
         self.date_format = date_format
+        self._df_handler = DfHandler()
         self.logger = logging.getLogger("pyrst.client")
         self.logger.info("Setting up JSON handler...")
         self.logger.info("JSON Handler options: date format is {date_format}, orientation is {orientation}."
@@ -127,11 +405,25 @@ class JsonHandler(Handler):
         :rtype: str
         """
 
-        self.logger.debug("Processing to DataFrame.")
-        _df = DfHandler().process(query_output=query_output)
-        self.logger.debug("Processing to DataFrame complete.")
+        self.logger.debug("Processing to DataFrame and exporting to JSON.")
+        return self._combine(self._map_shards(query_output))
+
+    def _process_shard(self,
+                       query_output,
+                       start,
+                       stop):
+        """
+        Converts the rows of the query output between `start` and `stop` into
+        their JSON representation.
 
-        self.logger.debug("Exporting to JSON.")
+        :param query_output: raw query output
+        :param start: index of the first row of the shard
+        :type start: int
+        :param stop: index after the last row of the shard
+        :type stop: int
+        :return: the representation of the shard as decoded JSON
+        """
+        _df = self._df_handler._process_shard(query_output, start, stop)
 
         res = _df.to_json(orient=self.orient,
                           date_format=self.date_format,
@@ -139,8 +431,49 @@ class JsonHandler(Handler):
 
         return json.loads(res)
 
+    def _combine(self,
+                 shards):
+        """
+        Combines the JSON representations of the shards in row order,
+        according to the encoding orientation.
 
-class CsvHandler(Handler):
+        :param shards: list of decoded JSON shards
+        :type shards: list
+        :return: the representation of the query results as decoded JSON
+        """
+        if len(shards) == 1:
+            return shards[0]
+
+        if self.orient == "split":
+            res = {"columns": shards[0]["columns"], "index": [], "data": []}
+            for shard in shards:
+                res["index"] += shard["index"]
+                res["data"] += shard["data"]
+        elif self.orient == "index":
+            res = {}
+            for shard in shards:
+                res.update(shard)
+        elif self.orient == "columns":
+            res = dict((column, {}) for column in shards[0])
+            for shard in shards:
+                for column, values in shard.items():
+                    res[column].update(values)
+        elif self.orient == "table":
+            res = {"schema": shards[0]["schema"], "data": []}
+            for shard in shards:
+                res["data"] += shard["data"]
+        elif self.orient in ("records", "values"):
+            res = []
+            for shard in shards:
+                res += shard
+        else:
+            raise ValueError("Cannot combine JSON shards with orientation {orient}."
+                             .format(orient=self.orient))
+
+        return res
+
+
+class CsvHandler(_ShardedHandler):
     """
     Handler that returns a CSV file, ready to be ingested by Excel etc..
 
@@ -153,7 +486,9 @@ class CsvHandler(Handler):
     def __init__(self,
                  sep=',',
                  encoding="utf-8",
-                 index=False):
+                 index=False,
+                 processes=None,
+                 shard_size=100000):
         """
         Creates a CSV handler.
 
@@ -164,10 +499,18 @@ class CsvHandler(Handler):
         :param index: whether to include index column in output (default:
         False)
         :type index: bool
+        :param processes: number of worker processes to convert the rows with
+        (default: None, converting the rows in the calling process)
+        :type processes: int
+        :param shard_size: number of rows converted by a worker at a time
+        :type shard_size: int
         """
+        super(CsvHandler, self).__init__(processes=processes,
+                                         shard_size=shard_size)
         self.sep = sep
         self.encoding = encoding
         self.index = index
+        self._df_handler = DfHandler()
         self.logger = logging.getLogger("pyrst.client")
         self.logger.info("Setting up CSV handler...")
         self.logger.info("CSV Handler options: separated by {separator}, encoding: {encoding}"
@@ -184,11 +527,40 @@ class CsvHandler(Handler):
         :rtype: str
         """
 
-        self.logger.debug("Processing to DataFrame.")
-        _df = DfHandler().process(query_output=query_output)
-        self.logger.debug("Processing to DataFrame complete.")
+        self.logger.debug("Processing to DataFrame and exporting to CSV.")
+        return self._combine(self._map_shards(query_output))
+
+    def _process_shard(self,
+                       query_output,
+                       start,
+                       stop):
+        """
+        Converts the rows of the query output between `start` and `stop` into
+        a CSV chunk. Only the first shard carries the header.
+
+        :param query_output: raw query output
+        :param start: index of the first row of the shard
+        :type start: int
+        :param stop: index after the last row of the shard
+        :type stop: int
+        :return: representation of the shard as a CSV string
+        :rtype: str
+        """
+        _df = self._df_handler._process_shard(query_output, start, stop)
 
-        self.logger.debug("Exporting to CSV.")
         return _df.to_csv(sep=self.sep,
                           encoding=self.encoding,
-                          index=self.index)
\ No newline at end of file
+                          index=self.index,
+                          header=start == 0)
+
+    def _combine(self,
+                 shards):
+        """
+        Concatenates the CSV chunks in row order.
+
+        :param shards: list of CSV chunks
+        :type shards: list
+        :return: representation of the result as a CSV string
+        :rtype: str
+        """
+        return "".join(shards)
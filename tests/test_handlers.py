@@ -0,0 +1,139 @@
+# coding=utf-8
+
+import unittest
+
+try:
+    from pandas.testing import assert_frame_equal
+except ImportError:
+    from pandas.util.testing import assert_frame_equal
+
+from pyrst.handlers import DfHandler, CsvHandler, JsonHandler
+
+
+def make_query_output(row_count=1050):
+    """
+    Creates a query output in the structure returned by `retrieve()`, with a
+    dimension column that has missing values and a different mix of values
+    in each part of the result, a dimension column with a distinct value in
+    each row and a measure column.
+    """
+    rows = []
+    for i in range(row_count):
+        if i < row_count // 3:
+            region = ["North", "South"][i % 2]
+        else:
+            region = ["East", "West", None, "North"][i % 4]
+        rows.append([[region, "customer-{i}".format(i=i), str(i * 1.5)]])
+
+    return {"columnNames": ["region", "customer", "sales"],
+            "rows": rows,
+            "dataTypes": [12, 12, 8],
+            "hasMoreRows": False}
+
+
+class ShardedHandlerTest(unittest.TestCase):
+    """
+    Checks that converting the rows in parallel shards gives the same result
+    as converting them in a single process.
+    """
+
+    sharding = {"processes": 3,
+                "shard_size": 100}
+
+    def setUp(self):
+        self.query_output = make_query_output()
+
+    def test_df_handler(self):
+        assert_frame_equal(DfHandler().process(self.query_output),
+                           DfHandler(**self.sharding).process(self.query_output))
+
+    def test_df_handler_categorical(self):
+        for categorical in ("auto", True):
+            assert_frame_equal(DfHandler(categorical=categorical).process(self.query_output),
+                               DfHandler(categorical=categorical, **self.sharding).process(self.query_output))
+
+    def test_csv_handler(self):
+        for index in (False, True):
+            self.assertEqual(CsvHandler(index=index).process(self.query_output),
+                             CsvHandler(index=index, **self.sharding).process(self.query_output))
+
+    def test_json_handler(self):
+        for orient in ("split", "records", "index", "columns", "values", "table"):
+            self.assertEqual(JsonHandler(orient=orient).process(self.query_output),
+                             JsonHandler(orient=orient, **self.sharding).process(self.query_output))
+
+    def test_uneven_shards(self):
+        assert_frame_equal(DfHandler().process(self.query_output),
+                           DfHandler(processes=2, shard_size=1049).process(self.query_output))
+
+    def test_single_shard(self):
+        assert_frame_equal(DfHandler().process(self.query_output),
+                           DfHandler(processes=3, shard_size=5000).process(self.query_output))
+
+    def test_invalid_options(self):
+        for handler in (DfHandler, CsvHandler, JsonHandler):
+            self.assertRaises(ValueError, handler, processes=0)
+            self.assertRaises(ValueError, handler, shard_size=0)
+            self.assertRaises(ValueError, handler, processes=2, shard_size=-100)
+
+
+class CategoricalTest(unittest.TestCase):
+    """
+    Checks the dictionary encoding of dimension columns by the DfHandler.
+    """
+
+    def setUp(self):
+        self.query_output = make_query_output()
+        self.plain = DfHandler().process(self.query_output)
+
+    def assert_same_values(self, df):
+        for column in self.plain.columns:
+            self.assertEqual(df[column].astype("object").where(df[column].notnull(), None).tolist(),
+                             self.plain[column].where(self.plain[column].notnull(), None).tolist())
+
+    def test_not_encoded_by_default(self):
+        self.assertEqual(self.plain["region"].dtype, "object")
+        self.assertEqual(self.plain["customer"].dtype, "object")
+
+    def test_encode_all_dimensions(self):
+        df = DfHandler(categorical=True).process(self.query_output)
+        self.assertEqual(str(df["region"].dtype), "category")
+        self.assertEqual(str(df["customer"].dtype), "category")
+        self.assertEqual(df["sales"].dtype, "float64")
+        self.assertEqual(list(df["region"].cat.categories), ["North", "South", "East", "West"])
+        self.assert_same_values(df)
+
+    def test_encode_low_cardinality_dimensions(self):
+        df = DfHandler(categorical="auto", max_categories=4).process(self.query_output)
+        self.assertEqual(str(df["region"].dtype), "category")
+        self.assertEqual(df["customer"].dtype, "object")
+        self.assert_same_values(df)
+
+        df = DfHandler(categorical="auto", max_categories=3).process(self.query_output)
+        self.assertEqual(df["region"].dtype, "object")
+
+    def test_decode_high_cardinality_dimensions(self):
+        for sharding in ({}, {"processes": 3, "shard_size": 100}):
+            df = DfHandler(categorical="auto", max_categories=4, **sharding).process(self.query_output)
+            assert_frame_equal(df[["customer", "sales"]], self.plain[["customer", "sales"]])
+
+    def test_merge_shard_dictionaries(self):
+        df = DfHandler(categorical=True, processes=3, shard_size=100).process(self.query_output)
+        self.assertEqual(list(df["region"].cat.categories), ["North", "South", "East", "West"])
+        self.assertEqual(len(df["customer"].cat.categories), 1050)
+        self.assert_same_values(df)
+
+    def test_merge_shard_without_values(self):
+        for each in self.query_output["rows"][:100]:
+            each[0][0] = None
+        self.plain = DfHandler().process(self.query_output)
+
+        for categorical in ("auto", True):
+            df = DfHandler(categorical=categorical, processes=3, shard_size=100).process(self.query_output)
+            self.assertEqual(list(df["region"].cat.categories), ["North", "South", "East", "West"])
+            self.assertEqual(df["region"][:100].isnull().sum(), 100)
+            self.assert_same_values(df)
+
+
+if __name__ == '__main__':
+    unittest.main()